@@ -5,92 +5,293 @@ Compresses images and creates thumbnails with optional watermarking
 """
 
 import argparse
+import contextlib
+import functools
+import io
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
 import sys
+import threading
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
-from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
+
+# Pillow-SIMD is a drop-in replacement for Pillow with SSE4/AVX2 resampling
+# (including the LANCZOS filter used below). To use it:
+#   pip uninstall pillow && CC="cc -mavx2" pip install pillow-simd
+from PIL import ExifTags, Image, ImageDraw, ImageFont, ImageOps, features
+
+try:
+    import pyvips
+    HAS_PYVIPS = True
+except (ImportError, OSError):
+    HAS_PYVIPS = False
 
 try:
     from tqdm import tqdm
     HAS_TQDM = True
 except ImportError:
     HAS_TQDM = False
-    print("Note: Install tqdm for progress bars: pip install tqdm")
 
 
-def process_photo(args_tuple):
-    """Process a single photo (must be top-level function for multiprocessing)"""
-    filepath, config = args_tuple
+# Originals larger than this are memory-mapped instead of read through Python buffers
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# Per-process config, installed once by the pool initializer instead of pickled per task
+_WORKER_CONFIG = None
 
-    min_path = filepath.with_name(filepath.stem + '.min' + filepath.suffix)
+# Per-process background writer, so writing one thumbnail overlaps decoding the next.
+# Failed writes are reported to main() through _WRITE_ERRORS, set by the pool initializer
+_WRITE_QUEUE = None
+_WRITER = None
+_WRITE_ERRORS = None
 
-    # Skip if already processed and not forcing
-    if not config['force'] and min_path.exists():
-        if min_path.stat().st_mtime > filepath.stat().st_mtime:
-            return {'status': 'skipped', 'file': filepath.name}
 
+def thumbnail_path(filepath):
+    """Path of the .min thumbnail for an image"""
+    return filepath.with_name(filepath.stem + '.min' + filepath.suffix)
+
+
+def _is_up_to_date(filepath):
+    """True if the thumbnail exists and is newer than the original (one stat each)"""
     try:
-        img = Image.open(filepath).convert('RGB')
-        width, height = img.size
+        return os.stat(thumbnail_path(filepath)).st_mtime > os.stat(filepath).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _writer_loop(write_queue, write_errors):
+    """Write queued (filepath, min_path, data) thumbnails to disk until the None sentinel"""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+
+        filepath, min_path, data = item
+        try:
+            min_path.write_bytes(data)
+        except Exception as e:
+            # Never let the thread die, the bounded queue would then block the worker forever
+            write_errors.put({
+                'status': 'error',
+                'file': filepath.name,
+                'path': str(filepath),
+                'error': f"Could not write {min_path.name}: {e}"
+            })
+
+
+def _write_async(filepath, min_path, data):
+    """Hand encoded bytes to the background writer, starting it on first use"""
+    global _WRITE_QUEUE, _WRITER
+
+    if _WRITER is None or not _WRITER.is_alive():
+        # Bounded, so a slow disk holds back encoding instead of piling up buffers
+        _WRITE_QUEUE = queue.Queue(maxsize=8)
+        _WRITER = threading.Thread(target=_writer_loop, args=(_WRITE_QUEUE, _WRITE_ERRORS))
+        _WRITER.start()
+
+        # Pool workers exit through multiprocessing's finalizers, drain the queue there
+        multiprocessing.util.Finalize(None, _flush_writes, exitpriority=10)
+
+    _WRITE_QUEUE.put((filepath, min_path, data))
+
+
+def _flush_writes():
+    """Wait until every queued thumbnail has been written"""
+    global _WRITE_QUEUE, _WRITER
+
+    if _WRITER is not None:
+        _WRITE_QUEUE.put(None)
+        _WRITER.join()
+        _WRITE_QUEUE = _WRITER = None
+
+
+@contextlib.contextmanager
+def _open_source(filepath):
+    """Open an image for decoding, memory-mapped when large so libjpeg reads from the page cache"""
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+        else:
+            yield f
 
-        # Add watermark if requested
-        if config.get('watermark') and config.get('watermark_text'):
-            img = add_watermark(img, config)
 
-        # Create thumbnail
-        ratio = config['min_width'] / width
-        new_size = (int(width * ratio), int(height * ratio))
+def _collect_write_errors(write_errors, collected):
+    """Move write error results from the queue into a list until the None sentinel"""
+    for error in iter(write_errors.get, None):
+        collected.append(error)
 
-        thumb = img.copy()
-        thumb.thumbnail(new_size, Image.Resampling.LANCZOS)
 
-        # Save optimized thumbnail
-        thumb.save(
-            min_path,
+def _init_worker(config, write_errors):
+    """Pool initializer: install the shared config and write error queue in this process"""
+    global _WORKER_CONFIG, _WRITE_ERRORS
+    _WORKER_CONFIG = config
+    _WRITE_ERRORS = write_errors
+
+
+def process_photo(task):
+    """Process a single photo (must be top-level function for multiprocessing)"""
+    filepath, new_size = task
+    config = _WORKER_CONFIG
+
+    min_path = thumbnail_path(filepath)
+
+    # libvips can't reproduce the Pillow watermark, so only use it for plain thumbnails
+    if HAS_PYVIPS and not config.get('watermark'):
+        return process_photo_vips(filepath, min_path, new_size, config)
+
+    try:
+        with _open_source(filepath) as source:
+            img = Image.open(source)
+
+            # new_size is for the upright image, the stored one may be turned sideways
+            rotated = _is_rotated(img)
+            stored_size = new_size[::-1] if rotated else new_size
+            width = img.height if rotated else img.width
+
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale (keeping 2x headroom for LANCZOS),
+            # staying in YCbCr (JPEG's native space) so neither decode nor encode converts colour
+            img.draft('YCbCr', (stored_size[0] * 2, stored_size[1] * 2))
+            if img.mode != 'YCbCr':
+                img = img.convert('YCbCr')
+            img.load()
+
+        # Cheap integer box reduce first, leaving only the last octave to LANCZOS
+        factor = int(img.width / stored_size[0] / 2)
+        if factor > 1:
+            img = img.reduce(factor)
+
+        # Rotate upright on the reduced image, Pillow doesn't copy EXIF into the saved thumbnail
+        ImageOps.exif_transpose(img, in_place=True)
+        scale = img.width / width
+
+        # Add watermark if requested
+        if config.get('watermark'):
+            add_watermark(img, config, scale)
+
+        # Create thumbnail at the size worked out from the header in main()
+        if img.size != new_size:
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+        # Encode in memory, the background writer puts it on disk. Baseline unless
+        # --optimize-coding: optimized/progressive Huffman tables cost an extra pass for a
+        # few percent of size, and the gallery does nothing progressive-specific
+        buf = io.BytesIO()
+        img.save(
+            buf,
             "JPEG",
             quality=config['quality'],
-            optimize=True,
-            progressive=True,
-            subsampling='4:2:0'  # Better compression for web
+            optimize=config['optimize_coding'],
+            progressive=config['optimize_coding'],
+            subsampling=2  # 4:2:0, better compression for web
         )
 
         img.close()
-        thumb.close()
+        _write_async(filepath, min_path, buf.getbuffer())
 
-        return {'status': 'processed', 'file': filepath.name}
+        return {'status': 'processed', 'file': filepath.name, 'path': str(filepath)}
     except Exception as e:
         return {'status': 'error', 'file': filepath.name, 'error': str(e)}
 
 
-def add_watermark(img, config):
-    """Add watermark to image"""
-    img = img.copy()
-    draw = ImageDraw.Draw(img)
+def _is_rotated(img):
+    """True if the EXIF orientation turns the image 90 degrees (orientations 5-8)"""
+    return img.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8)
 
-    # Try to load custom font, fall back to default if not found
+
+def probe_image(filepath, min_width):
+    """Read only the image header to size its thumbnail (upright, never upscaled)"""
+    try:
+        with Image.open(filepath) as img:
+            width, height = img.size
+            if _is_rotated(img):
+                width, height = height, width
+    except Exception as e:
+        return {'status': 'error', 'file': filepath.name, 'error': str(e)}
+
+    if width > min_width:
+        new_size = (min_width, max(1, round(height * min_width / width)))
+    else:
+        new_size = (width, height)
+
+    return {'status': 'ok', 'path': filepath, 'new_size': new_size, 'area': width * height}
+
+
+def process_photo_vips(filepath, min_path, new_size, config):
+    """Create a thumbnail with libvips (shrink-on-load, streamed in scanlines)"""
+    try:
+        # Exactly the size main() worked out from the header, same as the Pillow path
+        # (it is for the upright image, which is what thumbnail's autorotate produces)
+        thumb = pyvips.Image.thumbnail(
+            str(filepath),
+            new_size[0],
+            height=new_size[1],
+            size='force'
+        )
+
+        data = thumb.jpegsave_buffer(
+            Q=config['quality'],
+            optimize_coding=config['optimize_coding'],
+            interlace=config['optimize_coding'],
+            subsample_mode='on',  # Always 4:2:0, same as the Pillow path
+            strip=True
+        )
+        _write_async(filepath, min_path, data)
+
+        return {'status': 'processed', 'file': filepath.name, 'path': str(filepath)}
+    except Exception as e:
+        return {'status': 'error', 'file': filepath.name, 'error': str(e)}
+
+
+def render_watermark(text, font_path, fontsize, opacity=1.0):
+    """Rasterize watermark text once into an RGBA stamp, returns (stamp, glyph offset)"""
     try:
-        font_path = config.get('font_path', './assets/font/Arial.ttf')
-        fontsize = config.get('fontsize', 48)
         font = ImageFont.truetype(font_path, fontsize)
-    except:
+    except OSError:
         font = ImageFont.load_default()
 
-    watermark_text = config['watermark_text']
+    left, top, right, bottom = font.getbbox(text)
 
-    # Calculate text position (centered bottom)
-    bbox = draw.textbbox((0, 0), watermark_text, font=font)
-    t_w = bbox[2] - bbox[0]
-    t_h = bbox[3] - bbox[1]
+    # Light gray watermark, glyph coverage times opacity kept in alpha so the
+    # per-image paste blends only the stamp's box
+    stamp = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (235, 235, 235, 0))
+    draw = ImageDraw.Draw(stamp)
+    draw.text((-left, -top), text, font=font, fill=(235, 235, 235, round(255 * opacity)))
 
-    width, height = img.size
-    x = (width - t_w) / 2
-    y = height - 2 * t_h
+    return stamp, (left, top)
 
-    # Light gray watermark (simulates transparency on JPEG)
-    fill = (235, 235, 235)
 
-    draw.text((x, y), watermark_text, font=font, fill=fill)
-    return img
+@functools.lru_cache(maxsize=8)
+def _watermark_stamp(size, mode):
+    """Rebuild the stamp from the worker config once per process, size and mode, returns (fill, mask)"""
+    stamp = Image.frombytes(
+        'RGBA',
+        _WORKER_CONFIG['watermark_stamp_size'],
+        _WORKER_CONFIG['watermark_stamp_bytes']
+    )
+    if stamp.size != size:
+        stamp = stamp.resize(size, Image.Resampling.LANCZOS)
+    return stamp.convert(mode), stamp.getchannel('A')
+
+
+def add_watermark(img, config, scale=1.0):
+    """Paste the pre-rendered watermark onto image in place, scaled to match a reduced-size decode"""
+    stamp_w, stamp_h = config['watermark_stamp_size']
+    t_w = max(1, round(stamp_w * scale))
+    t_h = max(1, round(stamp_h * scale))
+    fill, mask = _watermark_stamp((t_w, t_h), img.mode)
+
+    # Calculate text position (centered bottom)
+    off_x, off_y = config['watermark_stamp_offset']
+    width, height = img.size
+    x = (width - t_w) // 2 + round(off_x * scale)
+    y = height - 2 * t_h + round(off_y * scale)
+
+    img.paste(fill, (x, y), mask=mask)
 
 
 def find_images(directory, recursive=True):
@@ -101,22 +302,52 @@ def find_images(directory, recursive=True):
         print(f"Error: Directory '{directory}' does not exist")
         sys.exit(1)
 
-    extensions = {'.jpg', '.jpeg', '.JPG', '.JPEG'}
+    # Case-insensitive .jpg/.jpeg, matched by the directory walker itself
+    patterns = ('*.[jJ][pP][gG]', '*.[jJ][pP][eE][gG]')
+    glob = directory.rglob if recursive else directory.glob
 
-    if recursive:
-        images = [
-            f for f in directory.rglob('*')
-            if f.suffix in extensions and not f.stem.endswith('.min')
-        ]
-    else:
-        images = [
-            f for f in directory.glob('*')
-            if f.suffix in extensions and not f.stem.endswith('.min')
-        ]
+    images = [
+        f for pattern in patterns for f in glob(pattern)
+        if not f.stem.endswith('.min')
+    ]
 
     return sorted(images)
 
 
+def get_pool_context():
+    """Multiprocessing context for the worker pool, forkserver where the platform has it"""
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+
+    # Workers fork from a clean server that already imported the heavy modules: cheaper
+    # than spawn re-importing them per worker, safer than fork with threaded C libraries.
+    # Workers still run this script's top level to find process_photo (preloading
+    # '__main__' only avoids that on newer Pythons), but its imports are then just
+    # lookups, and the top level has no other side effects
+    preload = [
+        '__main__',
+        'PIL.Image', 'PIL.ImageDraw', 'PIL.ImageFont', 'PIL.ImageOps', 'PIL.JpegImagePlugin'
+    ]
+    if HAS_PYVIPS:
+        preload.append('pyvips')
+    if HAS_TQDM:
+        preload.append('tqdm')
+
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(preload)
+    return ctx
+
+
+def collect_results(results, total):
+    """Drain an iterator of process_photo results, with a progress bar if available"""
+    if HAS_TQDM:
+        return list(tqdm(results, total=total, desc="Processing", unit="img"))
+
+    results = list(results)
+    print(f"Processed {len(results)} images")
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Batch process photos for web gallery - creates optimized thumbnails',
@@ -129,6 +360,9 @@ Examples:
   # High quality thumbnails with 8 parallel workers
   python photo_processor.py assets/Street --quality 90 --min-width 1600 --workers 8
 
+  # Smallest files for archival runs (progressive, optimized Huffman tables)
+  python photo_processor.py assets/2024 --optimize-coding
+
   # Force reprocess all images (even if thumbnails exist)
   python photo_processor.py assets/2024 --force
 
@@ -145,8 +379,10 @@ Examples:
                        help='Width of thumbnail in pixels (default: 1200)')
     parser.add_argument('--quality', type=int, default=85,
                        help='JPEG quality 1-100 (default: 85)')
-    parser.add_argument('--workers', type=int, default=4,
-                       help='Number of parallel workers (default: 4)')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of parallel workers (default: 1.25x the CPUs, at least 4, or half the CPUs with pyvips)')
+    parser.add_argument('--optimize-coding', action='store_true',
+                       help='Write progressive JPEGs with optimized Huffman tables (slightly smaller, slower to encode)')
     parser.add_argument('--force', action='store_true',
                        help='Force reprocess all images, even if thumbnails exist')
     parser.add_argument('--no-recursive', action='store_true',
@@ -155,6 +391,8 @@ Examples:
                        help='Add watermark to original images')
     parser.add_argument('--watermark-text', default='',
                        help='Watermark text (e.g., "© Your Name 2025")')
+    parser.add_argument('--watermark-opacity', type=float, default=1.0,
+                       help='Watermark opacity 0-1, below 1 blends it with the photo (default: 1.0)')
     parser.add_argument('--font-path', default='./assets/font/Arial.ttf',
                        help='Path to font file for watermark')
     parser.add_argument('--fontsize', type=int, default=48,
@@ -162,11 +400,18 @@ Examples:
 
     args = parser.parse_args()
 
+    if not HAS_TQDM:
+        print("Note: Install tqdm for progress bars: pip install tqdm")
+
     # Validation
     if args.quality < 1 or args.quality > 100:
         print("Error: Quality must be between 1 and 100")
         sys.exit(1)
 
+    if args.watermark_opacity <= 0 or args.watermark_opacity > 1:
+        print("Error: Watermark opacity must be greater than 0 and at most 1")
+        sys.exit(1)
+
     if args.min_width < 100:
         print("Error: Minimum width must be at least 100 pixels")
         sys.exit(1)
@@ -182,55 +427,130 @@ Examples:
 
     print(f"Found {len(images)} images in {directory}")
 
+    # Skip up-to-date images here so the pool only sees real work (stat is I/O-bound, use threads)
+    skipped = 0
+    if not args.force:
+        with ThreadPoolExecutor() as executor:
+            up_to_date = list(executor.map(_is_up_to_date, images))
+        skipped = sum(up_to_date)
+        images = [img for img, done in zip(images, up_to_date) if not done]
+        print(f"Skipped {skipped} already-up-to-date images (pre-filter)")
+
     if args.watermark and not args.watermark_text:
         print("Warning: --watermark enabled but no --watermark-text provided, skipping watermark")
         args.watermark = False
 
+    # Watermarked runs always go through Pillow, see process_photo
+    use_vips = HAS_PYVIPS and not args.watermark
+
+    # Oversubscribe the CPUs a little so the codec stays busy while workers wait on disk.
+    # libvips is internally threaded, so it needs fewer processes to fill the CPUs
+    if args.workers is None:
+        cpus = os.cpu_count() or 4
+        args.workers = max(1, cpus // 2) if use_vips else max(4, cpus + cpus // 4)
+
     # Prepare config
     config = {
-        'min_width': args.min_width,
         'quality': args.quality,
-        'force': args.force,
-        'watermark': args.watermark,
-        'watermark_text': args.watermark_text,
-        'font_path': args.font_path,
-        'fontsize': args.fontsize
+        'optimize_coding': args.optimize_coding,
+        'watermark': args.watermark
     }
 
+    # Render the watermark once here, workers only paste it
+    if args.watermark:
+        stamp, offset = render_watermark(
+            args.watermark_text, args.font_path, args.fontsize, args.watermark_opacity
+        )
+        config['watermark_stamp_bytes'] = stamp.tobytes()
+        config['watermark_stamp_size'] = stamp.size
+        config['watermark_stamp_offset'] = offset
+
     # Show settings
     print(f"\nSettings:")
     print(f"  Thumbnail width: {args.min_width}px")
     print(f"  JPEG quality: {args.quality}")
+    print(f"  Optimized coding: {'Yes' if args.optimize_coding else 'No'}")
     print(f"  Parallel workers: {args.workers}")
+    print(f"  Backend: {'pyvips' if use_vips else 'Pillow'}")
     print(f"  Force reprocess: {'Yes' if args.force else 'No'}")
+    turbo_version = features.version('libjpeg_turbo')
+    jpeg_library = f"libjpeg-turbo {turbo_version}" if turbo_version else "libjpeg"
+    print(f"  JPEG library: {jpeg_library} (API {features.version('jpg')})")
     if args.watermark:
-        print(f"  Watermark: '{args.watermark_text}'")
+        print(f"  Watermark: '{args.watermark_text}' (opacity {args.watermark_opacity:g})")
     print()
 
-    # Process in parallel with progress bar
-    with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        tasks = [(img, config) for img in images]
-
-        if HAS_TQDM:
-            results = list(tqdm(
-                executor.map(process_photo, tasks),
-                total=len(images),
-                desc="Processing",
-                unit="img"
-            ))
-        else:
-            results = list(executor.map(process_photo, tasks))
-            print(f"Processed {len(results)} images")
+    if not turbo_version:
+        print("Warning: Pillow is not linked against libjpeg-turbo, JPEG decode/encode will be slow")
+        print("See PHOTO_PROCESSOR_README.md for how to rebuild Pillow with libjpeg-turbo\n")
 
-    # Summary
-    processed = [r for r in results if r['status'] == 'processed']
-    skipped = [r for r in results if r['status'] == 'skipped']
-    errors = [r for r in results if r['status'] == 'error']
+    # Read only the headers (threaded, it's I/O-bound) to size every thumbnail up front,
+    # then hand out the largest images first so stragglers don't leave workers idle
+    with ThreadPoolExecutor() as executor:
+        probes = list(executor.map(functools.partial(probe_image, min_width=args.min_width), images))
+    probe_errors = [p for p in probes if p['status'] == 'error']
+    probes = sorted((p for p in probes if p['status'] == 'ok'), key=lambda p: -p['area'])
+    tasks = [(p['path'], p['new_size']) for p in probes]
+
+    # Process in parallel with progress bar
+    failed_writes = []
+    if len(tasks) <= 1 or args.workers == 1:
+        # Not worth forking workers and pickling tasks, run in-process
+        write_errors = queue.SimpleQueue()
+        _init_worker(config, write_errors)
+        try:
+            results = collect_results(map(process_photo, tasks), len(tasks))
+        finally:
+            _flush_writes()
+
+        write_errors.put(None)
+        _collect_write_errors(write_errors, failed_writes)
+    else:
+        # Unordered results so a slow image doesn't hold up the rest, chunked to cut IPC.
+        # The largest images go out one at a time first, so a single chunk doesn't put
+        # all of them on the same worker
+        head = args.workers * 2
+        chunksize = max(1, len(tasks) // (args.workers * 4))
+        ctx = get_pool_context()
+
+        # Workers report failed writes (possibly after their last result) through this queue
+        write_errors = ctx.Queue()
+        collector = threading.Thread(
+            target=_collect_write_errors, args=(write_errors, failed_writes), daemon=True
+        )
+        collector.start()
+
+        pool = ctx.Pool(args.workers, initializer=_init_worker, initargs=(config, write_errors))
+        with pool:
+            results = collect_results(
+                itertools.chain(
+                    pool.imap_unordered(process_photo, tasks[:head]),
+                    pool.imap_unordered(process_photo, tasks[head:], chunksize=chunksize)
+                ),
+                len(tasks)
+            )
+
+            # Let workers exit cleanly so their writers finish (__exit__ would terminate them)
+            pool.close()
+            pool.join()
+
+        write_errors.put(None)
+        collector.join()
+
+    results += probe_errors
+
+    # Summary, images whose thumbnail failed to write count as errors, not processed
+    failed_paths = {err['path'] for err in failed_writes}
+    processed = [
+        r for r in results
+        if r['status'] == 'processed' and r['path'] not in failed_paths
+    ]
+    errors = [r for r in results if r['status'] == 'error'] + failed_writes
 
     print(f"\n{'='*60}")
     print(f"Results:")
     print(f"  [+] Processed: {len(processed)} images")
-    print(f"  [-] Skipped: {len(skipped)} images (already up to date)")
+    print(f"  [-] Skipped: {skipped} images (already up to date)")
     if errors:
         print(f"  [!] Errors: {len(errors)} images")
         for err in errors: